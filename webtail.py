@@ -6,6 +6,7 @@ HTTP server that provides a web interface to run "tail" on a file,
 like the Unix command.
 
 This is a standalone script. No external dependencies required.
+The event loop of uvloop is used if it is installed.
 
 How to invoke:
 
@@ -27,15 +28,96 @@ __email1__ = 'scoffey@itba.edu.ar'
 __author2__ = 'Vladimir Vassilev'
 __email2__ = 'vladimir@lightside-instruments.com'
 
-import http.server
-import socketserver
+import asyncio
 import collections
+import concurrent.futures
+import ctypes
+import email.utils
+import functools
+import gzip
+import hashlib
+import http
 import logging
 import os
+import signal
+import socket
+import struct
 import sys
+import time
 #import urlparse
-import urllib
+import urllib.parse
 
+try:
+    import uvloop
+except ImportError: # optional, faster drop-in event loop
+    uvloop = None
+
+
+# size of the blocks read when scanning a file
+_BLOCK_SIZE = 1 << 20
+
+# size of the blocks read backwards by tail()
+_TAIL_BLOCK_SIZE = 64 * 1024
+
+# URL path -> name of the WebTailHTTPRequestHandler method serving it
+_ROUTES = {
+    '/': '_get_static',
+    '/tail': '_get_tail',
+    '/linecount': '_get_linecount'
+}
+
+# http_headers entries formatted by WebTailHTTPRequestHandler._head() itself
+_BLOCK_HEADERS = frozenset(('Content-Type', 'Content-Length'))
+
+# maximum number of header lines of a request, as in http.client
+_MAX_HEADERS = 100
+
+# query string parameters understood by the request handler
+_QUERY_KEYS = frozenset(('filename', 'offset', 'limit'))
+
+# threads scanning and compressing files, sized for the parallelism of the
+# storage rather than the CPUs; stat() and open() stay in the default
+# executor so that they are not queued behind a long scan
+_SCAN_POOL = concurrent.futures.ThreadPoolExecutor( \
+        max_workers=min(4, os.cpu_count() or 1), thread_name_prefix='scan')
+
+# filename -> (bytes counted, st_mtime_ns, st_ino, line count, last bytes
+# counted) of the last count
+_LINECOUNT_CACHE = {}
+
+# maximum number of files counted in _LINECOUNT_CACHE
+_LINECOUNT_CACHE_MAX = 64
+
+# number of last counted bytes compared to tell a grown file from a rewritten one
+_LINECOUNT_SAMPLE = 64
+
+# filename -> (st_size, st_mtime_ns, st_ino, time.monotonic() of the stat),
+# for the files whose changes are reported by the FileWatcher
+_FILE_META = {}
+
+# seconds after which a _FILE_META entry is refreshed even without events
+_FILE_META_MAX_AGE = 1.0
+
+# maximum number of files watched by the FileWatcher
+_WATCHES_MAX = 64
+
+# filename -> _SharedFile kept open for the next requests
+_OPEN_FILES = {}
+
+# maximum number of files kept open in _OPEN_FILES
+_OPEN_FILES_MAX = 64
+
+# seconds after which an unused file of _OPEN_FILES is closed, so that a
+# deleted log does not keep its disk space allocated
+_OPEN_FILES_MAX_IDLE = 5.0
+
+# tail responses between these sizes are gzipped for clients accepting it,
+# smaller ones are not worth it and larger ones are better sent by sendfile()
+_GZIP_MIN_SIZE = 1024
+_GZIP_MAX_SIZE = 8 << 20
+
+# byte range of a _SharedFile to be sent as response body
+_FileRange = collections.namedtuple('_FileRange', 'file offset count')
 
 _STATIC_HTML = """<html>
 <head>
@@ -117,106 +199,649 @@ window.onblur = refresh;
 </html>
 """
 
-class WebTailHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
-    """ Request handler for the web tail server """
+_STATIC_HTML_BYTES = _STATIC_HTML.encode('utf-8')
+_STATIC_HTML_GZIP = gzip.compress(_STATIC_HTML_BYTES, mtime=0)
+_HTML_ETAG = '"%s"' % hashlib.sha1(_STATIC_HTML_BYTES).hexdigest()[:16]
+_HTML_GZIP_ETAG = _HTML_ETAG[:-1] + '-gzip"'
+
+@functools.lru_cache(maxsize=1)
+def _date_header(timestamp):
+    """ Returns the Date header line, formatted once per second """
+    return ('Date: %s\r\n' % \
+            email.utils.formatdate(timestamp, usegmt=True)).encode('latin-1')
+
+class FileWatcher(object):
+    """ Watches the tailed files with inotify(7) and drops their entry from
+        _FILE_META whenever they change, so that polling clients can be
+        answered from _FILE_META without a stat() per request.
+
+        Linux only: raises OSError or AttributeError where inotify is not
+        available, NotImplementedError where the event loop cannot watch
+        file descriptors. """
+
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_IGNORED = 0x8000
+
+    MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_DELETE_SELF | \
+            IN_MOVE_SELF
+
+    _EVENT = struct.Struct('iIII') # wd, mask, cookie, len of inotify_event
+
+    def __init__(self, loop):
+        libc = ctypes.CDLL(None, use_errno=True)
+        self._inotify_add_watch = libc.inotify_add_watch
+        self._inotify_rm_watch = libc.inotify_rm_watch
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.watches = {} # watch descriptor -> filename
+        self.filenames = {} # filename -> watch descriptor, oldest first
+        self.generations = {} # filename -> number of events seen
+        self.loop = loop
+        try:
+            loop.add_reader(self.fd, self._read_events)
+        except NotImplementedError:
+            os.close(self.fd)
+            raise
+
+    def watch(self, filename):
+        """ Starts watching a file, returns False if it cannot be watched """
+        if filename in self.filenames:
+            return True
+        if len(self.filenames) >= _WATCHES_MAX:
+            oldest = next(iter(self.filenames))
+            self._unwatch(self.filenames[oldest], remove=True)
+        wd = self._inotify_add_watch(self.fd, os.fsencode(filename), self.MASK)
+        if wd < 0 or wd in self.watches:
+            # not watchable, or another name of a watched file
+            return False
+        self.watches[wd] = filename
+        self.filenames[filename] = wd
+        self.generations[filename] = 0
+        return True
+
+    def _unwatch(self, wd, remove):
+        """ Forgets a watch, removing it from the kernel unless it is gone """
+        filename = self.watches.pop(wd)
+        del self.filenames[filename]
+        del self.generations[filename]
+        _FILE_META.pop(filename, None)
+        if remove:
+            self._inotify_rm_watch(self.fd, wd)
+
+    def close(self):
+        self.loop.remove_reader(self.fd)
+        os.close(self.fd)
+
+    def _read_events(self):
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, length = self._EVENT.unpack_from(data, pos)
+            pos += self._EVENT.size + length
+            filename = self.watches.get(wd)
+            if filename is None:
+                continue
+            _FILE_META.pop(filename, None)
+            self.generations[filename] += 1
+            if mask & (self.IN_IGNORED | self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+                # rotated or removed: watch the new file on the next request;
+                # the kernel keeps watching a moved file until told otherwise
+                self._unwatch(wd, remove=bool(mask & self.IN_MOVE_SELF))
+
+def _parse_query(query):
+    """ Returns the known parameters of a query string as a dict.
+
+        Single pass replacement for dict(urllib.parse.parse_qsl(query)), only
+        unquoting the values that need it. """
+    request = {}
+    for pair in query.split('&'):
+        key, _, value = pair.partition('=')
+        if value and key in _QUERY_KEYS: # blank values are dropped
+            if '%' in value or '+' in value:
+                value = urllib.parse.unquote_plus(value)
+            request[key] = value
+    return request
+
+def _qvalue(params):
+    """ Returns the q parameter of an Accept-Encoding coding, 1 when it is
+        missing or malformed """
+    for param in params.split(';'):
+        key, _, value = param.partition('=')
+        if key.strip().lower() == 'q':
+            try:
+                return float(value)
+            except ValueError:
+                return 1.0
+    return 1.0
+
+class _SharedFile(object):
+    """ A file kept open across requests, which saves an open() and close()
+        per poll. Readers must not depend on the file position.
+
+        Closed once it has been replaced in _OPEN_FILES (e.g. after a log
+        rotation) or left unused for _OPEN_FILES_MAX_IDLE, and the last
+        request using it is done. """
+
+    def __init__(self, filename):
+        self.stream = open(filename, 'rb')
+        self.st_ino = os.fstat(self.stream.fileno()).st_ino
+        self.users = 0
+        self.replaced = False
+        self.last_used = time.monotonic()
+
+    def acquire(self):
+        self.users += 1
+        return self
+
+    def release(self):
+        self.users -= 1
+        self.last_used = time.monotonic()
+        if self.replaced and not self.users:
+            self.stream.close()
+
+    def replace(self):
+        self.replaced = True
+        if not self.users:
+            self.stream.close()
+
+class WebTailHTTPRequestHandler(object):
+    """ Request handler for the web tail server.
+
+        Serves the requests of one (keep-alive) client connection on the
+        asyncio event loop. Blocking file I/O is handed to an executor so a
+        slow read never stalls the other clients. """
 
     protocol_version = 'HTTP/1.1'
+    server_version = 'WebTail/' + __version__
 
     filename = None # determines file to tail
+    watcher = None # FileWatcher keeping _FILE_META current, if available
+    close_connection = False # the connection ends after the response
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
 
-    def do_GET(self):
+    async def handle(self):
+        """ Handles requests until the client closes the connection """
+        try:
+            while await self.handle_one_request():
+                await self.writer.drain()
+            await self.writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # server stopped: end the connection like a hang-up, as the
+            # asyncio.start_server() callback logs cancelled handlers
+            pass
+        finally:
+            self.writer.close()
+
+    async def handle_one_request(self):
+        """ Parses and serves one request, returns False to close """
+        try:
+            line = await self.reader.readline()
+            if not line:
+                return False
+            self.command, self.path, self.request_version = \
+                    line.decode('latin-1').split()
+            self.headers = {}
+            count = 0
+            while True:
+                line = await self.reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                count += 1
+                if count > _MAX_HEADERS:
+                    return self._refuse(431)
+                key, _, value = line.decode('latin-1').partition(':')
+                self.headers[key.strip().lower()] = value.strip()
+        except ValueError: # malformed request line or line too long
+            return self._refuse(400)
+
+        self.close_connection = \
+                self.headers.get('connection', '').lower() == 'close' or \
+                self.request_version != self.protocol_version
+        if 'transfer-encoding' in self.headers or \
+                self.headers.get('content-length', '0') != '0':
+            # request bodies are not read: hang up rather than parse the
+            # body as the next request
+            self.close_connection = True
+        if self.command == 'GET':
+            await self.do_GET()
+        else:
+            self.close_connection = True
+            self.http_headers = {}
+            self._serve(b'', 501)
+        return not self.close_connection
+
+    def _refuse(self, http_status):
+        """ Answers a request that cannot be served and ends the connection,
+            returns False for handle_one_request() """
+        self.close_connection = True
         self.http_headers = {}
-        routes = {
-            '/': lambda request: _STATIC_HTML,
-            '/tail': self._get_tail
-        }
+        self._serve(b'', http_status)
+        return False
+
+    async def do_GET(self):
+        self.http_headers = {}
+        self.http_status = 200
         try:
-            url = urllib.parse.urlsplit(self.path)
-            request = dict(urllib.parse.parse_qsl(url.query))
-            if url.path in routes:
+            url_path, _, query = self.path.partition('?')
+            name = _ROUTES.get(url_path)
+            if name is not None:
+                request = _parse_query(query)
                 print("filename=%s"%(request.get('filename', 0)))
-                handler = routes[url.path]
-                body = handler(request)
-                self._serve(body, 200)
+                body = getattr(self, name)(request)
+                if asyncio.iscoroutine(body):
+                    body = await body
             else: # not found
-                self._serve('', 400)
+                body, self.http_status = b'', 404
         except Exception:
             logging.exception('Failed to handle request at %s', self.path)
-            self._serve('', 500)
-
-    def _get_tail(self, request):
+            self.http_headers = {}
+            body, self.http_status = b'', 500
+        if isinstance(body, _FileRange):
+            await self._serve_file(body, self.http_status)
+        else:
+            self._serve(body, self.http_status)
 
-        if(self.filename==None):
-            filename = request.get('filename', "")
+    def _get_static(self, request):
+        self.http_headers['Vary'] = 'Accept-Encoding'
+        if self._accepts_gzip():
+            self.http_headers['Content-Encoding'] = 'gzip'
+            etag, body = _HTML_GZIP_ETAG, _STATIC_HTML_GZIP
         else:
-            filename = self.filename
+            etag, body = _HTML_ETAG, _STATIC_HTML_BYTES
+        self.http_headers['ETag'] = etag
+        if self._not_modified(etag):
+            self.http_status = 304
+            return b''
+        return body
+
+    def _not_modified(self, etag):
+        """ Tells whether the If-None-Match of the request matches etag """
+        header = self.headers.get('if-none-match')
+        if not header:
+            return False
+        for tag in header.split(','):
+            tag = tag.strip()
+            if tag.startswith('W/'): # weak comparison
+                tag = tag[2:]
+            if tag == etag or tag == '*':
+                return True
+        return False
+
+    def _accepts_gzip(self):
+        """ Tells whether the Accept-Encoding of the request allows gzip,
+            a listed gzip or x-gzip taking precedence over * """
+        wildcard = False
+        for coding in self.headers.get('accept-encoding', '').split(','):
+            name, _, params = coding.partition(';')
+            name = name.strip().lower()
+            accepted = _qvalue(params) > 0
+            if name in ('gzip', 'x-gzip'):
+                return accepted
+            if name == '*':
+                wildcard = accepted
+        return wildcard
+
+    def _get_filename(self, request):
+        if(self.filename==None):
+            return request.get('filename', "")
+        return self.filename
+
+    async def _get_tail(self, request):
 
-        size = os.stat(filename).st_size
+        filename = self._get_filename(request)
+
+        size, mtime_ns, st_ino = await self._stat(filename)
         self.http_headers['Content-Type'] = 'text/plain'
+        self.http_headers['Vary'] = 'Accept-Encoding'
         self.http_headers['X-Seek-Offset'] = str(size)
         offset = int(request.get('offset', 0))
         limit = int(request.get('limit', 0)) or None
         if size <= offset:
             logging.info('tail returned empty string with stat optimization')
-            return ''
-        new_offset, lines = self.tail(filename, offset, limit)
-        logging.info('tail(%r, %r, %r) returned offset %d and %d lines', \
-                filename, offset, limit, new_offset, len(lines))
+            return b''
+        gzipped = self._accepts_gzip()
+        etag = '"%x-%x-%x-%x-%x%s"' % (st_ino, size, mtime_ns, offset, \
+                limit or 0, '-gzip' if gzipped else '')
+        self.http_headers['ETag'] = etag
+        if self._not_modified(etag):
+            # the cached X-Seek-Offset of the lines is still valid, the size
+            # would point past an incomplete last line
+            del self.http_headers['X-Seek-Offset']
+            self.http_status = 304
+            return b''
+        shared = await self._open(filename, st_ino)
+        try:
+            start, new_offset = await self.loop.run_in_executor(_SCAN_POOL, \
+                    self.tail, shared.stream.fileno(), offset, limit, size)
+        except BaseException:
+            shared.release()
+            raise
+        logging.info('tail(%r, %r, %r) returned bytes %d to %d', \
+                filename, offset, limit, start, new_offset)
         self.http_headers['X-Seek-Offset'] = str(new_offset)
-        return ''.join(lines)
+        count = new_offset - start
+        if not count:
+            shared.release()
+            return b''
+        if not (gzipped and _GZIP_MIN_SIZE <= count <= _GZIP_MAX_SIZE):
+            return _FileRange(shared, start, count)
+        try:
+            body = await self.loop.run_in_executor(_SCAN_POOL, \
+                    self._gzip_range, shared.stream.fileno(), start, count)
+        finally:
+            shared.release()
+        self.http_headers['Content-Encoding'] = 'gzip'
+        return body
+
+    def _gzip_range(self, fd, offset, count):
+        """ Returns a byte range of a file descriptor compressed by gzip """
+        data = os.pread(fd, count, offset)
+        if len(data) < count:
+            raise OSError('file was truncated while reading it')
+        return gzip.compress(data, compresslevel=1)
+
+    async def _open(self, filename, st_ino):
+        """ Returns the acquired _SharedFile of a file, reopening it when
+            the inode behind filename has changed """
+        shared = _OPEN_FILES.get(filename)
+        if shared is not None and shared.st_ino == st_ino:
+            return shared.acquire()
+        shared = await self.loop.run_in_executor(None, _SharedFile, filename)
+        old = _OPEN_FILES.pop(filename, None)
+        if old is not None:
+            old.replace()
+        if len(_OPEN_FILES) >= _OPEN_FILES_MAX:
+            _OPEN_FILES.pop(next(iter(_OPEN_FILES))).replace()
+        _OPEN_FILES[filename] = shared
+        return shared.acquire()
+
+    async def _stat(self, filename):
+        """ Returns (st_size, st_mtime_ns, st_ino) of a file, from _FILE_META
+            when the file is watched and has not changed since the last stat """
+        meta = _FILE_META.get(filename)
+        if meta is not None and \
+                time.monotonic() - meta[3] < _FILE_META_MAX_AGE:
+            return meta[:3]
+        watcher = self.watcher
+        if watcher is not None and watcher.watch(filename):
+            generation = watcher.generations[filename]
+        else:
+            generation = None
+        st = await self.loop.run_in_executor(None, os.stat, filename)
+        if generation is not None and \
+                watcher.generations.get(filename) == generation:
+            # no change event arrived during the stat, so it is current
+            _FILE_META[filename] = (st.st_size, st.st_mtime_ns, st.st_ino, \
+                    time.monotonic())
+        return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+    async def _get_linecount(self, request):
+
+        filename = self._get_filename(request)
+
+        self.http_headers['Content-Type'] = 'text/plain'
+        count = await self.loop.run_in_executor(_SCAN_POOL, \
+                self.linecount, filename)
+        return b'%d' % count
 
     def _serve(self, body, http_status=200):
-        self.send_response(http_status)
-        self.http_headers.setdefault('Content-Type', 'text/html')
+        if http_status == 304: # Not Modified: no body, and no length for it
+            self.http_headers['Content-Length'] = None
         self.http_headers.setdefault('Content-Length', len(body))
-        self.http_headers.setdefault('Connection', 'keep-alive')
-        for k, v in self.http_headers.items():
-            self.send_header(k, v)
-        self.end_headers()
-        self.wfile.write(body.encode())
-
-    def tail(self, filename, offset=0, limit=None):
-        """ Returns lines in a file (from given offset, up to limit lines) """
-        lines = collections.deque([], limit)
-        stream = open(filename)
-        stream.seek(offset)
-        for line in stream:
-            if not line.endswith('\n'): # ignore last line if incomplete
+        self.writer.write(self._head(http_status) + body) # one send()
+
+    async def _serve_file(self, body, http_status=200):
+        """ Sends a byte range of a file with sendfile(), so the payload is
+            copied from the page cache to the socket by the kernel """
+        self.http_headers['Content-Length'] = body.count
+        self._cork(True) # the head goes out in the first segment of the file
+        try:
+            self.writer.write(self._head(http_status))
+            try:
+                # no fallback: it seeks and reads the shared stream
+                sent = await self.loop.sendfile(self.writer.transport, \
+                        body.file.stream, body.offset, body.count, \
+                        fallback=False)
+            except (NotImplementedError, asyncio.SendfileNotAvailableError):
+                # e.g. uvloop, no os.sendfile(), or it failed before sending
+                sent = await self._send_range(body.file.stream.fileno(), \
+                        body.offset, body.count)
+            finally:
+                body.file.release()
+        finally:
+            self._cork(False)
+        if sent < body.count: # Content-Length already sent, must hang up
+            raise ConnectionError('%s was truncated while sending it' % \
+                    body.file.stream.name)
+
+    async def _send_range(self, fd, offset, count):
+        """ Writes a byte range of a file descriptor to the client, for the
+            event loops without sendfile(). Returns the bytes written. """
+        sent = 0
+        while sent < count:
+            block = await self.loop.run_in_executor(None, os.pread, fd, \
+                    min(_BLOCK_SIZE, count - sent), offset + sent)
+            if not block:
                 break
-            lines.append(line)
-            offset += len(line)
-        stream.close()
+            self.writer.write(block)
+            await self.writer.drain()
+            sent += len(block)
+        return sent
+
+    def _cork(self, cork):
+        """ Sets TCP_CORK on the connection where supported, to hold back
+            partial segments until it is cleared """
+        if hasattr(socket, 'TCP_CORK'):
+            try:
+                self.writer.get_extra_info('socket').setsockopt( \
+                        socket.IPPROTO_TCP, socket.TCP_CORK, cork)
+            except OSError: # connection already closed
+                pass
+
+    def _head(self, http_status):
+        """ Returns the status line and headers of a response """
+        headers = self.http_headers
+        head = [self._header_block(http_status, \
+                    headers.get('Content-Type', 'text/html'), \
+                    'close' if self.close_connection else 'keep-alive'), \
+                _date_header(int(time.time()))]
+        if headers['Content-Length'] is not None: # varies, so not cached
+            head.append(b'Content-Length: %d\r\n' % headers['Content-Length'])
+        for k, v in headers.items():
+            if k not in _BLOCK_HEADERS:
+                head.append(('%s: %s\r\n' % (k, v)).encode('latin-1'))
+        head.append(b'\r\n')
+        return b''.join(head)
+
+    @classmethod
+    @functools.lru_cache(maxsize=256)
+    def _header_block(cls, http_status, content_type, connection):
+        """ Returns the status line and the headers common to all responses,
+            formatted once for each combination of their values """
+        head = '%s %d %s\r\nServer: %s\r\nContent-Type: %s\r\n' % \
+                (cls.protocol_version, http_status, \
+                 http.HTTPStatus(http_status).phrase, cls.server_version, \
+                 content_type)
+        head += 'Connection: %s\r\n' % connection
+        return head.encode('latin-1')
+
+    def tail(self, fd, offset=0, limit=None, size=None):
+        """ Returns the byte range (start, end) of the lines in a file
+            descriptor (from given offset to size, up to the last limit lines).
+
+            Reads backwards from size with preadv() into a single buffer, so
+            the I/O is bounded by the returned lines rather than the size of
+            the file, and the descriptor can be shared. """
+        if size is None:
+            size = os.fstat(fd).st_size
+        block = bytearray(_TAIL_BLOCK_SIZE)
+        view = memoryview(block)
+        end = None
+        newlines = 0
+        pos = size
+        while pos > offset:
+            length = min(_TAIL_BLOCK_SIZE, pos - offset)
+            pos -= length
+            i = os.preadv(fd, [view[:length]], pos)
+            if end is None:
+                i = block.rfind(b'\n', 0, i) # ignore last line if incomplete
+                if i < 0:
+                    continue
+                end = pos + i + 1
+                if not limit:
+                    return (offset, end)
+                newlines += 1
+            found = block.count(b'\n', 0, i)
+            if newlines + found <= limit:
+                newlines += found
+                continue
+            while newlines <= limit:
+                i = block.rfind(b'\n', 0, i)
+                newlines += 1
+            return (pos + i + 1, end)
+
+        if end is None:
+            return (offset, offset)
+        return (offset, end)
+
+    def linecount(self, filename):
+        """ Returns the number of complete lines in a file.
+
+            The count is cached. When the file has grown since, only the
+            appended bytes are counted; a smaller or replaced file (e.g.
+            after a log rotation) is counted again from the start, as is a
+            file whose last counted bytes have changed (e.g. truncated by
+            copytruncate and written past its old size). A file rewritten
+            with the same last bytes is taken as grown. """
+        st = os.stat(filename)
+        cached = _LINECOUNT_CACHE.get(filename)
+        if cached is not None and \
+                cached[:3] == (st.st_size, st.st_mtime_ns, st.st_ino):
+            return cached[3]
+
+        pos = count = 0
+        last = b''
+        fd = os.open(filename, os.O_RDONLY)
+        try:
+            if cached is not None and cached[2] == st.st_ino and \
+                    cached[0] <= st.st_size and cached[1] <= st.st_mtime_ns:
+                sample = cached[4]
+                if os.pread(fd, len(sample), cached[0] - len(sample)) == sample:
+                    pos, count, last = cached[0], cached[3], sample
+            while pos < st.st_size: # bytes appended later are counted next time
+                block = os.pread(fd, min(_BLOCK_SIZE, st.st_size - pos), pos)
+                if not block:
+                    break
+                count += block.count(b'\n')
+                pos += len(block)
+                last = (last + block[-_LINECOUNT_SAMPLE:])[-_LINECOUNT_SAMPLE:]
+        finally:
+            os.close(fd)
+        _LINECOUNT_CACHE.pop(filename, None)
+        if len(_LINECOUNT_CACHE) >= _LINECOUNT_CACHE_MAX:
+            # list() rather than iter(): other scan threads may update it
+            for oldest in list(_LINECOUNT_CACHE)[:1]:
+                _LINECOUNT_CACHE.pop(oldest, None)
+        _LINECOUNT_CACHE[filename] = (pos, st.st_mtime_ns, st.st_ino, count, last)
+        return count
+
+class WebTailServer(object):
+    """ Web tail server.
 
-        return (offset, lines)
+        Multiplexes all client connections on a single asyncio event loop
+        instead of running a thread per connection. Errors while processing
+        a connection are logged without stopping the server.
 
-    def log_request(self, code='-', size='-'):
-        pass
+        The listening socket can be bound with server_bind() before forking,
+        so that several worker processes accept connections from it. """
 
-class WebTailServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
-    """ Web tail server.
+    def __init__(self, server_address, RequestHandlerClass):
+        self.server_address = server_address
+        self.RequestHandlerClass = RequestHandlerClass
+        self.socket = None
 
-        Only differs from http.server.HTTPServer in the handling of
-        exceptions while processing requests. """
+    def server_bind(self):
+        """ Binds the listening socket, failing if the address is in use.
 
-    def _handle_request_noblock(self):
-        try:
-            request, client_address = self.get_request()
-        except socket.error:
-            return
-        if self.verify_request(request, client_address):
+            Host names like localhost are bound over IPv4 as by
+            socketserver.TCPServer, only IPv6 literals over IPv6. """
+        host, port = self.server_address
+        family = socket.AF_INET6 if ':' in host else socket.AF_INET
+        self.socket = socket.create_server((host, port), family=family)
+
+    async def serve_forever(self):
+        watcher = None
+        if sys.platform.startswith('linux'):
             try:
-                self.process_request(request, client_address)
-            except KeyboardInterrupt:
-                self.close_request(request)
-                raise # pass on interruption in order to stop server
-            except Exception:
-                self.handle_error(request, client_address)
-                self.close_request(request)
-
-    def handle_error(self, request, client_address):
-        logging.exception('Error while processing request from %s:%d', \
-                *client_address)
+                watcher = FileWatcher(asyncio.get_running_loop())
+            except (OSError, AttributeError, NotImplementedError):
+                pass
+        if watcher is None:
+            logging.info('inotify not available, files are stat()ed on every request')
+        self.RequestHandlerClass.watcher = watcher
+        if self.socket is None:
+            self.server_bind()
+        server = await asyncio.start_server(self._handle_connection, \
+                sock=self.socket)
+        expiry = asyncio.create_task(self._close_idle_files())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            expiry.cancel()
+            if watcher is not None:
+                watcher.close()
+
+    async def _close_idle_files(self):
+        """ Periodically closes the files of _OPEN_FILES that have not been
+            used for _OPEN_FILES_MAX_IDLE """
+        while True:
+            await asyncio.sleep(_OPEN_FILES_MAX_IDLE)
+            now = time.monotonic()
+            for filename, shared in list(_OPEN_FILES.items()):
+                if not shared.users and \
+                        now - shared.last_used > _OPEN_FILES_MAX_IDLE:
+                    del _OPEN_FILES[filename]
+                    shared.replace()
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            await self.RequestHandlerClass(reader, writer).handle()
+        except Exception:
+            self.handle_error(writer.get_extra_info('peername'))
 
+    def handle_error(self, client_address):
+        logging.exception('Error while processing request from %s:%d', \
+                *client_address[:2])
+
+
+def _fork_workers(count):
+    """ Forks count worker processes. Returns their pids in the parent
+        process and an empty list in the workers. """
+    children = []
+    for _ in range(count):
+        pid = os.fork()
+        if pid == 0:
+            return []
+        children.append(pid)
+    if children: # let main() stop the workers when terminated
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    return children
 
 def main(program, interface="127.0.0.1", port=7411, filename=None, **kwargs):
     """ Main program: Runs the web tail HTTP server """
@@ -225,14 +850,29 @@ def main(program, interface="127.0.0.1", port=7411, filename=None, **kwargs):
     if filename is None:
         logging.info('No input filename specified on command line. Using filename parameter from requests instead!!!')
 
+    httpd = WebTailServer((interface, int(port)), WebTailHTTPRequestHandler)
+    httpd.server_bind() # shared by the workers
+    if not hasattr(os, 'fork'):
+        workers = 1
+    elif hasattr(os, 'sched_getaffinity'): # the CPUs this process may use
+        workers = len(os.sched_getaffinity(0))
+    else:
+        workers = os.cpu_count() or 1
+    children = []
     try:
-        Handler = WebTailHTTPRequestHandler
-        with socketserver.TCPServer((interface, int(port)), Handler) as httpd:
-            print("Starting tail ...")
-            print("Serving at: http://%(interface)s:%(port)s" % dict(interface=interface or "localhost", port=port))
-            httpd.serve_forever()
+        print("Starting tail ...")
+        print("Serving at: http://%(interface)s:%(port)s" % dict(interface=interface or "localhost", port=port))
+        sys.stdout.flush() # not to be repeated by the forked workers
+        children = _fork_workers(workers - 1)
+        run = asyncio.run if uvloop is None else uvloop.run
+        run(httpd.serve_forever())
     except KeyboardInterrupt:
         logging.info('HTTP server stopped')
+    finally:
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+        for pid in children:
+            os.waitpid(pid, 0)
 
 if __name__ == '__main__':
     logging.basicConfig(stream=sys.stderr, level=logging.INFO, \